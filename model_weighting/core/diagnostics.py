@@ -35,49 +35,152 @@ import re
 import sys
 import logging
 import warnings
-import regionmask
+import functools
 import numpy as np
 import xarray as xr
-from cdo import Cdo
 
 from .utils_xarray import (
-    detrend,
-    trend,
-    correlation,
+    detrend_axis,
+    trend_axis,
+    correlation_axis,
     flip_antimeridian,
     area_weighted_mean,
 )
 
-cdo = Cdo()
 logger = logging.getLogger(__name__)
 
 REGION_DIR = '{}/../shapefiles/'.format(os.path.dirname(__file__))
 MASK = 'land_sea_mask_regionsmask.nc'
+# netCDF output chunks along lat/lon (other dimensions in chunks of up to 120)
+CHUNKS = {'lat': 30, 'lon': 60}
+# all input files are expected on the same regular 2.5x2.5 degree grid
+_EXPECTED_LAT = np.arange(-88.75, 90., 2.5)
+_EXPECTED_LON = np.arange(-178.75, 180., 2.5)
+SEASON_MONTHS = {'JJA': [6, 7, 8], 'SON': [9, 10, 11], 'DJF': [12, 1, 2], 'MAM': [3, 4, 5]}
+
+
+def _grid_key(da):
+    """Hashable description of a regular lat/lon grid: (first, last, size)."""
+    lats, lons = da['lat'].data, da['lon'].data
+    return (lats[0], lats[-1], lats.size), (lons[0], lons[-1], lons.size)
+
+
+def _grid_from_key(key):
+    lats, lons = key
+    return xr.Dataset(coords={'lat': np.linspace(*lats), 'lon': np.linspace(*lons)})
+
+
+def _as_grid_mask(mask, da):
+    """Wrap a cached (lat, lon) array using the coordinates of da."""
+    return xr.DataArray(mask, dims=('lat', 'lon'),
+                        coords={'lat': da['lat'], 'lon': da['lon']})
+
+
+@functools.lru_cache()
+def _srex_mask(key):
+    """Integer SREX region mask for a given grid (cached per grid)."""
+    import regionmask  # only needed for masking; slow to import
+    return regionmask.defined_regions.srex.mask(_grid_from_key(key)).data
+
+
+@functools.lru_cache()
+def _land_mask(key):
+    """Boolean natural earth land mask for a given grid (cached per grid)."""
+    import regionmask
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        mask = regionmask.defined_regions.natural_earth.land_110.mask(_grid_from_key(key))
+    return mask.data == 0
+
+
+def _netcdf_encoding(ds):
+    """Compressed encoding blocked along lat/lon for all variables in ds."""
+    encoding = {}
+    for varn, da in ds.data_vars.items():
+        if da.ndim == 0:
+            continue
+        encoding[varn] = {
+            'zlib': True, 'complevel': 1, 'shuffle': True,
+            'chunksizes': tuple(
+                min(CHUNKS.get(dim, 120), size) for dim, size in zip(da.dims, da.shape))}
+    return encoding
+
+
+def _single_precision(ds):
+    """Cast all floating variables in ds to float32 (as they are stored)."""
+    for varn, da in ds.data_vars.items():
+        if np.issubdtype(da.dtype, np.floating):
+            ds[varn] = da.astype(np.float32)
+    return ds
+
+
+def _read_variable(filename, varn, time_period=None):
+    """
+    Read a single variable into memory, optionally only a given time period.
+
+    The CF attributes _FillValue, missing_value, scale_factor, and add_offset
+    are applied explicitly in the data type of the file (or single precision
+    for packed integer data), instead of having xarray promote them to double.
+    """
+    da = xr.open_dataset(filename, use_cftime=True, mask_and_scale=False)[varn]
+    if time_period is not None:
+        da = da.sel(time=slice(str(time_period[0]), str(time_period[1])))
+    da = da.load()  # read only once, all further steps work in memory
+    attrs = dict(da.attrs)
+    fill_values = [attrs.pop(key) for key in ['_FillValue', 'missing_value'] if key in attrs]
+    fill_values = [value for value in fill_values if not np.isnan(value)]  # NaN is already missing
+    scale_factor = attrs.pop('scale_factor', None)
+    add_offset = attrs.pop('add_offset', None)
+    if not fill_values and scale_factor is None and add_offset is None:
+        da.attrs = attrs
+        da.encoding = {}
+        return da
+
+    if not np.issubdtype(da.dtype, np.floating):
+        da = da.astype(np.float32)
+    for fill_value in np.unique(fill_values):
+        da = da.where(da != da.dtype.type(fill_value))
+    if scale_factor is not None:
+        da = da * da.dtype.type(scale_factor)
+    if add_offset is not None:
+        da = da + da.dtype.type(add_offset)
+    da.attrs = attrs
+    da.encoding = {}
+    return da
 
 
 def calculate_net_radiation(infile, varns, outname, diagn):
     assert varns == ('rlds', 'rlus', 'rsds', 'rsus')
-    da1 = xr.open_dataset(infile, decode_cf=False)[varns[0]]
-    da2 = xr.open_dataset(infile.replace(varns[0], varns[1]), decode_cf=False)[varns[1]]
-    da3 = xr.open_dataset(infile.replace(varns[0], varns[2]), decode_cf=False)[varns[2]]
-    da4 = xr.open_dataset(infile.replace(varns[0], varns[3]), decode_cf=False)[varns[3]]
-
-    da = (da1-da2) + (da3-da4)
-    da.attrs['units'] = da1.units
+    # open lazily: the arithmetic is streamed chunk by chunk on writing
+    # NOTE: shared variables (e.g., time_bnds) are taken from the first file
+    # NOTE: join='inner' keeps only common time steps (like the arithmetic)
+    ds = xr.open_mfdataset(
+        [infile.replace(varns[0], varn) for varn in varns],
+        decode_cf=False, combine='by_coords', compat='override', join='inner',
+        chunks={'time': 120})
+
+    # stay in the input dtype (typically float32) and save one temporary
+    da = ds[varns[0]] - ds[varns[1]]
+    da += ds[varns[2]] - ds[varns[3]]
+    da.attrs['units'] = ds[varns[0]].units
     try:
-        da.attrs['_FillValue'] = da1._FillValue
+        da.attrs['_FillValue'] = ds[varns[0]]._FillValue
     except AttributeError:
         da.attrs['_FillValue'] = 1e20
     da.attrs['long_name'] = 'Surface Downwelling Net Radiation'
     da.attrs['standard_name'] = 'surface_downwelling_net_flux_in_air'
     # TODO: units; positive direction definition as attrs
-    ds = da.to_dataset(name=diagn)
+    ds = _single_precision(da.to_dataset(name=diagn))
 
-    ds.to_netcdf(outname)
+    ds.to_netcdf(outname, encoding=_netcdf_encoding(ds))
 
 
 def standardize_units(da, varn):
     """Convert units to a common standard"""
+    # NOTE: conversions use augmented assignment on da.data, which works in
+    # place without a temporary copy and keeps attrs.
+    # Constants are cast to the data type to avoid upcasting (e.g., float32);
+    # integer data are converted to float first so they are not truncated.
     if 'units' in da.attrs.keys():
         unit = da.attrs['units']
     else:
@@ -85,11 +188,14 @@ def standardize_units(da, varn):
         logger.warning(logmsg)
         return None
 
+    if not np.issubdtype(da.dtype, np.floating):
+        da = da.astype(float)
+
     # --- precipitation ---
     if varn == 'pr':
         newunit = 'mm/day'
         if unit == 'kg m-2 s-1':
-            da.data *= 24*60*60
+            da.data *= da.dtype.type(24*60*60)
             da.attrs['units'] = newunit
         elif unit == 'mm':
             logmsg = '\n'.join([
@@ -104,10 +210,10 @@ def standardize_units(da, varn):
                 'of daily data! This means that the unit actually represents',
                 'values per day and not sums as might, intuitively, be expected!',
                 'Will change unit from "m" to "m/day" and then transfer to "mm/day"!'])
-            da.data *= 1000
+            da.data *= da.dtype.type(1000)
             da.attrs['units'] = newunit
         elif unit == 'm/day':  # ERA5
-            da.data *= 1000
+            da.data *= da.dtype.type(1000)
             da.attrs['units'] = newunit
         elif unit == newunit:
             pass
@@ -121,7 +227,7 @@ def standardize_units(da, varn):
         if unit == newunit:
             pass
         elif unit in ['K', 'Kelvin']:
-            da.data -= 273.15
+            da.data -= da.dtype.type(273.15)
             da.attrs['units'] = newunit
         elif unit.lower() in ['degc', 'deg_c', 'celsius', 'degreec',
                               'degree_c', 'degree_celsius']:
@@ -139,7 +245,7 @@ def standardize_units(da, varn):
         elif unit == 'pa':
             da.attrs['units'] = newunit
         elif unit in ['hPa', 'hpa']:
-            da.data *= 100.
+            da.data *= da.dtype.type(100.)
             da.attrs['units'] = newunit
         else:
             logmsg = 'Unit {} not covered for {}'.format(unit, varn)
@@ -167,7 +273,7 @@ def standardize_units(da, varn):
                 '<cdo chunit,"J m**-2","J m**-2/day infile outfile>'])
             raise ValueError(errmsg)
         elif unit == 'J m**-2/day':
-            da.data /= 24*60*60
+            da.data /= da.dtype.type(24*60*60)
             da.attrs['units'] = newunit
         else:
             logmsg = 'Unit {} not covered for {}'.format(unit, varn)
@@ -204,13 +310,14 @@ def average_season(da, season, full_seasons_only=True):
     Returns
     -------
     da_mean : same as input with time dimension averaged by season and renamed to year
+        Means are accumulated (and returned) in double precision.
         Note that for the winter season the new year dimension labels winters by the
         original year of January and February (i.e., the winter season 2000/2001 is
         labeled 2001!)
     """
     assert season in ['JJA', 'SON', 'DJF', 'MAM', 'ANN', None]
     if season != 'DJF':
-        return da.groupby('time.year').mean('time', skipna=False)
+        return da.groupby('time.year').mean('time', skipna=False, dtype=np.float64)
 
     def get_season_label(time):
         """Label each season by the year of Jannyary & February"""
@@ -241,8 +348,32 @@ def average_season(da, season, full_seasons_only=True):
         assert months_per_group[-1] == 1
         assert np.all([mm == 3 for mm in months_per_group[1:-1]])
 
-    return da_grouped.mean('time')
+    return da_grouped.mean('time', dtype=np.float64)
+
 
+def average_climatology(da, season):
+    """
+    Mean of seasonal (annual) means.
+
+    If all years contain the same number of time steps this is identical to
+    a plain mean over the time dimension, which avoids the intermediate
+    grouping step. Otherwise fall back to averaging per season first.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Has to contain at least the time dimension.
+    season : string {'JJA', 'SON', 'DJF', 'MAM', 'ANN'} or None
+
+    Returns
+    -------
+    da_mean : same as input with time dimension removed (in double precision)
+    """
+    if season != 'DJF':  # DJF seasons extend over two years
+        _, counts = np.unique(da['time'].dt.year.data, return_counts=True)
+        if np.all(counts == counts[0]):
+            return da.mean('time', skipna=False, dtype=np.float64)
+    return average_season(da, season).mean('year', skipna=False)
 
 
 def calculate_basic_diagnostic(infile, varn,
@@ -295,42 +426,47 @@ def calculate_basic_diagnostic(infile, varn,
     """
     if not overwrite and outfile is not None and os.path.isfile(outfile):
         logger.debug('Diagnostic already exists & overwrite=False, skipping.')
-        return xr.open_dataset(outfile, use_cftime=True)
+        # load once and release the file handle straight away
+        with xr.open_dataset(outfile, use_cftime=True) as ds:
+            return ds.load()
 
     if id_ == 'CMIP6':  # need to concat historical file and delete 'height'
         scenario = infile.split('_')[-3]
-        da = xr.open_dataset(infile, use_cftime=True)[varn]
+        da = _read_variable(infile, varn, time_period)
         if scenario != 'historical':
             assert re.compile('[rcps]{3}[0-9]{3}$').match(scenario), 'not a scenario!'
             histfile = infile.replace(scenario, 'historical')
-            da_hist = xr.open_dataset(histfile, use_cftime=True)[varn]
+            da_hist = _read_variable(histfile, varn, time_period)
             da = xr.concat([da_hist, da], dim='time')
     else:
-        da = xr.open_dataset(infile, use_cftime=True)[varn]
+        da = _read_variable(infile, varn, time_period)
 
     try:
         da = da.drop_vars('height')
     except ValueError:
         pass
 
-    da = standardize_units(da, varn)
-    da = flip_antimeridian(da)
-    assert np.all(da['lat'].data == np.arange(-88.75, 90., 2.5))
-    assert np.all(da['lon'].data == np.arange(-178.75, 180., 2.5))
-
-    if time_period is not None:
-        da = da.sel(time=slice(str(time_period[0]), str(time_period[1])))
-
     # NOTE: CAMS-CSM1-0 is missing the last year!
     if str(time_period[1]) == '2100' and 'CAMS-CSM1-0' in infile:
         da = da.sel(time=slice(None, '2099'))
 
+    da = standardize_units(da, varn)
+    da = flip_antimeridian(da)
+    # NOTE: only check size and end points, set DEBUG for a full comparison
+    for coord, expected in [('lat', _EXPECTED_LAT), ('lon', _EXPECTED_LON)]:
+        values = da[coord].data
+        assert (values.size == expected.size and
+                values[0] == expected[0] and values[-1] == expected[-1])
+        if os.environ.get('DEBUG'):
+            assert np.array_equal(values, expected)
+
+
     if id_ in ['CMIP6', 'CMIP5', 'CMIP3', 'LE'] and np.any(np.isnan(da.data)):
         import ipdb; ipdb.set_trace()
         raise ValueError('Missing value in model detected!')
 
-    if season in ['JJA', 'SON', 'DJF', 'MAM']:
-        da = da.isel(time=da['time.season'] == season)
+    if season in SEASON_MONTHS:
+        da = da.isel(time=np.isin(da['time'].dt.month.data, SEASON_MONTHS[season]))
     elif season is None or season == 'ANN':
         pass
     else:
@@ -339,25 +475,21 @@ def calculate_basic_diagnostic(infile, varn,
     if isinstance(mask_land_sea, bool) and not mask_land_sea:
         pass
     elif mask_land_sea == 'sea':
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            sea_mask = regionmask.defined_regions.natural_earth.land_110.mask(da) == 0
+        sea_mask = _as_grid_mask(_land_mask(_grid_key(da)), da)
         da = da.where(sea_mask)
     elif mask_land_sea == 'land':
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            land_mask = np.isnan(regionmask.defined_regions.natural_earth.land_110.mask(da))
+        land_mask = _as_grid_mask(~_land_mask(_grid_key(da)), da)
         da = da.where(land_mask)
     else:
         logger.error(f'mask {mask_land_sea} not implementend')
         raise NotImplementedError
 
     if time_aggregation == 'ANOM-GLOBAL':
-        da_mean = average_season(da, season)
-        da_mean = da_mean.mean('year', skipna=False)
+        da_mean = average_climatology(da, season)
         da_mean = area_weighted_mean(da_mean)
 
     if region != 'GLOBAL':
+        import regionmask
         if (isinstance(region, str) and
             region not in regionmask.defined_regions.srex.abbrevs):
             # if region is not a SREX region read coordinate file
@@ -375,19 +507,14 @@ def calculate_basic_diagnostic(infile, varn,
             if lonmax > 180 or lonmin < -180 or latmax > 90 or latmin < -90:
                 raise ValueError(f'Wrong lat/lon value in {regionfile}')
 
-            lats, lons = da['lat'].data, da['lon'].data
-            lats = lats[(lats >= latmin) & (lats <= latmax)]
-            lons = lons[(lons >= lonmin) & (lons <= lonmax)]
-            da = da.sel(lat=lats, lon=lons)
+            # lat & lon are ascending (asserted above) so a plain slice
+            # selects the same box without fancy indexing
+            da = da.sel(lat=slice(latmin, latmax), lon=slice(lonmin, lonmax))
         else:
             if isinstance(region, str):
                 region = [region]
-            masks = []
             keys = regionmask.defined_regions.srex.map_keys(region)
-            for key in keys:
-                masks.append(
-                    regionmask.defined_regions.srex.mask(da) == key)
-            mask = sum(masks) == 1
+            mask = _as_grid_mask(np.isin(_srex_mask(_grid_key(da)), keys), da)
             da = da.where(mask, drop=True)
 
         if np.all(np.isnan(da.isel(time=0))):
@@ -410,11 +537,9 @@ def calculate_basic_diagnostic(infile, varn,
 
         if time_aggregation == 'CLIM':
             # mean of seasonal (annual) means
-            da = average_season(da, season)
-            da = da.mean('year', skipna=False)
+            da = average_climatology(da, season)
         elif time_aggregation == 'ANOM-LOCAL':
-            da = average_season(da, season)
-            da = da.mean('year', skipna=False)
+            da = average_climatology(da, season)
 
             size = (~np.isnan(da)).sum()  # number of not NAN grid cells
             if size == 1:
@@ -430,44 +555,43 @@ def calculate_basic_diagnostic(infile, varn,
                 logger.warning(logmsg)
             da -= area_weighted_mean(da)
         elif time_aggregation == 'ANOM-GLOBAL':
-            da = average_season(da, season)
-            da = da.mean('year', skipna=False)
+            da = average_climatology(da, season)
             da -= da_mean
 
         elif time_aggregation == 'STD':
             # standard deviation of de-trended seasonal (annual) means
             da = average_season(da, season)
-            da = xr.apply_ufunc(detrend, da,
+            da = xr.apply_ufunc(detrend_axis, da,
                                 input_core_dims=[['year']],
                                 output_core_dims=[['year']],
-                                vectorize=True,
+                                kwargs={'axis': -1},
                                 keep_attrs=True)
             da = da.std('year', skipna=False)
         elif time_aggregation in ['TREND', 'TREND-MEAN']:
             # trend of seasonal (annual) means
             da = average_season(da, season)
-            da = xr.apply_ufunc(trend, da,
+            da = xr.apply_ufunc(trend_axis, da,
                                 input_core_dims=[['year']],
                                 output_core_dims=[[]],
-                                vectorize=True,
+                                kwargs={'axis': -1},
                                 keep_attrs=True)
             attrs['units'] = '{} year**-1'.format(attrs['units'])
         elif time_aggregation == 'CYC':
             # seasonal cycle over all years
-            da = da.groupby('time.month').mean('time')
+            da = da.groupby('time.month').mean('time', dtype=np.float64)
         elif time_aggregation is None or time_aggregation == 'CORR':
             pass
         else:
             NotImplementedError(f'time_aggregation={time_aggregation}')
 
-    ds = da.to_dataset(name=varn)
+    ds = _single_precision(da.to_dataset(name=varn))
     ds[varn].attrs = attrs
     if outfile is not None:
-        ds.to_netcdf(outfile)
+        ds.to_netcdf(outfile, encoding=_netcdf_encoding(ds))
     return ds
 
 
-def calculate_diagnostic(infile, diagn, base_path, **kwargs):
+def calculate_diagnostic(infile, diagn, base_path, persist_intermediates=False, **kwargs):
     """
     Calculate basic or derived diagnostics depending on input.
 
@@ -485,6 +609,10 @@ def calculate_diagnostic(infile, diagn, base_path, **kwargs):
           calculate the correlation between tas and clt.
     base_path : str
         The path in which to save the calculated diagnostic file.
+    persist_intermediates : bool, optional
+        Only used for time_aggregation='CORR'. If True also save the basic
+        diagnostics of both variables, otherwise (default) keep them in
+        memory and only save the correlation.
     kwargs : dict
         Keyword arguments passed on to calculate_basic_diagnostic.
 
@@ -538,6 +666,14 @@ def calculate_diagnostic(infile, diagn, base_path, **kwargs):
             assert len(varns) == 2, 'can only correlate two variables'
             assert varns[0] != varns[1], 'can not correlate same variables'
             outfile1 = get_outfile(infile=infile, **kwargs)
+            outfile3 = outfile1.replace(f'/{varns[0]}_', f'/{diagn}_')
+            if not kwargs.get('overwrite', False) and os.path.isfile(outfile3):
+                logger.debug('Diagnostic already exists & overwrite=False, skipping.')
+                with xr.open_dataset(outfile3, use_cftime=True) as ds3:
+                    return ds3.load()
+
+            if not persist_intermediates:
+                outfile1 = None
             ds1 = calculate_basic_diagnostic(infile, varns[0], outfile1, **kwargs)
 
             # !! '.../...Datasets...'.replace('tas', 'pr') -> '.../...Daprets...' !!
@@ -546,13 +682,12 @@ def calculate_diagnostic(infile, diagn, base_path, **kwargs):
             fn = fn.replace(f'{varns[0]}_', f'{varns[1]}_')
             path = (path+'/').replace(f'/{varns[0]}/', f'/{varns[1]}/')
             infile2 = os.path.join(path, fn)
-            outfile2 = get_outfile(infile=infile2, **kwargs)
+            outfile2 = get_outfile(infile=infile2, **kwargs) if persist_intermediates else None
             ds2 = calculate_basic_diagnostic(infile2, varns[1], outfile2, **kwargs)
-            da = xr.apply_ufunc(correlation, ds1[varns[0]], ds2[varns[1]],
+            da = xr.apply_ufunc(correlation_axis, ds1[varns[0]], ds2[varns[1]],
                                 input_core_dims=[['time'], ['time']],
-                                vectorize=True)
-            outfile3 = outfile1.replace(f'/{varns[0]}_', f'/{diagn}_')
-            ds3 = da.to_dataset(name=diagn)
+                                kwargs={'axis': -1})
+            ds3 = _single_precision(da.to_dataset(name=diagn))
             ds3[diagn].attrs = {'units': '1'}
-            ds3.to_netcdf(outfile3)
+            ds3.to_netcdf(outfile3, encoding=_netcdf_encoding(ds3))
             return ds3
@@ -36,7 +36,6 @@ import subprocess
 import numpy as np
 import xarray as xr
 import __main__ as main
-from scipy import stats, signal
 from scipy.spatial.distance import pdist, squareform
 from statsmodels.stats.weightstats import DescrStatsW
 
@@ -264,23 +263,72 @@ def distance_uncertainty(var, obs_min, obs_max):
     return diff
 
 
-def detrend(data):
-    if np.any(np.isnan(data)):
-        return data * np.nan
-    return signal.detrend(data)
+def _valid_slices(axis, *arrays):
+    """Move axis to the end and select the slices without missing values.
 
+    Returns a boolean mask of valid slices (shape of the arrays without axis)
+    and for each array its valid slices with shape (N_valid, n).
+    """
+    arrays = [np.moveaxis(np.asarray(arr), axis, -1) for arr in arrays]
+    valid = ~np.any([np.isnan(arr).any(axis=-1) for arr in arrays], axis=0)
+    return valid, [arr[valid] for arr in arrays]
 
-def trend(data):
-    if np.any(np.isnan(data)):
-        return np.nan
-    xx = np.arange(len(data))
-    return stats.linregress(xx, data).slope
+
+def _fill_invalid(valid, values):
+    """Inverse of _valid_slices: put values back, invalid slices are NaN."""
+    result = np.full(valid.shape + values.shape[1:], np.nan, dtype=values.dtype)
+    result[valid] = values
+    return result
+
+
+def _linear_fit(data):
+    """Closed-form least-squares fit of data against its index along the last
+    axis. Returns the anomalies of the index and of data as well as the slope
+    (with the last axis kept for broadcasting)."""
+    xx = np.arange(data.shape[-1], dtype=data.dtype)
+    xm = xx - xx.mean()
+    ym = data - data.mean(axis=-1, keepdims=True)
+    slope = (xm*ym).sum(axis=-1, keepdims=True) / (xm*xm).sum()
+    return xm, ym, slope
 
 
-def correlation(arr1, arr2):
-    if np.any(np.isnan(arr1)) or np.any(np.isnan(arr2)):
-        return np.nan
-    return stats.pearsonr(arr1, arr2)[0]
+def detrend_axis(data, axis=-1):
+    """Remove the linear trend along axis for all other dimensions at once.
+
+    Equivalent to calling signal.detrend(data, axis=axis) but slices containing
+    any missing value are returned as NaN.
+    """
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(float)
+    valid, (data,) = _valid_slices(axis, data)
+    xm, ym, slope = _linear_fit(data)
+    return np.moveaxis(_fill_invalid(valid, ym - slope*xm), -1, axis)
+
+
+def trend_axis(data, axis=-1):
+    """Least-squares slope of data along axis for all other dimensions at once.
+
+    Equivalent to calling stats.linregress(np.arange(n), data).slope for each
+    1D slice along axis. Slices containing any missing value return NaN.
+    """
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(float)
+    valid, (data,) = _valid_slices(axis, data)
+    _, _, slope = _linear_fit(data)
+    return _fill_invalid(valid, slope[:, 0])
+
+
+def correlation_axis(arr1, arr2, axis=-1):
+    """Pearson correlation of arr1 and arr2 along axis for all other
+    dimensions at once. Slices containing any missing value return NaN."""
+    valid, (arr1, arr2) = _valid_slices(axis, arr1, arr2)
+    am = arr1 - arr1.mean(axis=-1, keepdims=True)
+    bm = arr2 - arr2.mean(axis=-1, keepdims=True)
+    num = (am*bm).sum(axis=-1)
+    den = np.sqrt((am**2).sum(axis=-1) * (bm**2).sum(axis=-1))
+    return _fill_invalid(valid, num / den)
 
 
 def _antimeridian_pacific(ds, lonn):